@@ -1,5 +1,5 @@
 """Direct imports."""
-from .binary_history_buffer import binary_history_buffer, bhb
+from .binary_history_buffer import binary_history_buffer, bhb, binary_history_buffer_array, bhba
 from .binary_history_buffer_z import binary_history_buffer_z, bhbz
 from .binary_history_buffer_log2 import binary_history_buffer_log2, bhbl2
 
@@ -7,6 +7,8 @@ from .binary_history_buffer_log2 import binary_history_buffer_log2, bhbl2
 __all__: list[str] = [
     "binary_history_buffer",
     "bhb",
+    "binary_history_buffer_array",
+    "bhba",
     "binary_history_buffer_z",
     "bhbz",
     "binary_history_buffer_log2",
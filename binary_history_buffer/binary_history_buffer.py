@@ -2,12 +2,53 @@
 
 from typing import Self
 from logging import DEBUG, Logger, NullHandler, getLogger
-from numpy import uint64, float64, minimum, integer
+from sys import byteorder
+from numpy import (
+    bool_,
+    uint8,
+    uint64,
+    float64,
+    nan,
+    integer,
+    full,
+    zeros,
+    zeros_like,
+    concatenate,
+    bitwise_count,
+    frombuffer,
+    unpackbits,
+    packbits,
+    count_nonzero,
+    asarray,
+    asfortranarray,
+)
+from numpy.typing import ArrayLike, NDArray
 
 
 _logger: Logger = getLogger(__name__)
 _logger.addHandler(NullHandler())
-_LOG_DEBUG: bool = _logger.isEnabledFor(DEBUG)
+
+
+# _BIT_MASKS[n] has the n least significant bits set
+_BIT_MASKS: tuple[int, ...] = tuple((1 << n) - 1 for n in range(65))
+
+# _SET_BITS[n] has only bit n set & _CLEAR_BITS[n] has all but bit n set. Precomputed so update()
+# does a single read-modify-write of the buffer word without creating NumPy scalars.
+_SET_BITS: tuple[uint64, ...] = tuple(uint64(1 << n) for n in range(64))
+_CLEAR_BITS: tuple[uint64, ...] = tuple(~bit for bit in _SET_BITS)
+
+
+def _ring_segments(head: int, size: int, start: int, length: int) -> tuple[tuple[int, int], ...]:
+    """Map the history window [start:start + length] onto a ring of size bits with the head at head.
+
+    Returns
+    -------
+    ((buffer bit position, number of bits), ...) in order of increasing age.
+    """
+    position: int = (head + 1 + start) % size
+    if position + length <= size:
+        return ((position, length),)
+    return ((position, size - position), (0, position + length - size))
 
 
 class binary_history_buffer:
@@ -22,20 +63,33 @@ class binary_history_buffer:
         limit: The maximum number of bits to store in the buffer. 0 = infinite.
         _initial_state: The initial state of the buffer. This is for internal use only. Leave as default.
         """
-        self.limit: uint64 = uint64(limit)
-        self.buffer: int = int(_initial_state)
-        self.updates: uint64 = uint64(_initial_state.bit_length() - 1)
-        self.hits: uint64 = uint64(_initial_state.bit_count() - 1)
+        length: int = _initial_state.bit_length() - 1
+        nwords: int = (max(int(limit), length, 1) + 63) >> 6
+        state: int = _initial_state ^ (1 << length)  # Strip the marker
+
+        # The buffer is a ring of bits written from the top down. _head is the bit position the next
+        # state will be written to so history bit i is at position (_head + 1 + i) modulo the ring size.
+        # Limited buffers wrap, unlimited buffers grow when the head runs off the bottom.
+        self.limit: int = int(limit)
+        self.buffer: NDArray[uint64] = frombuffer(
+            (state << ((nwords << 6) - length)).to_bytes(nwords << 3, byteorder), dtype=uint64
+        ).copy()
+        # _wrap is where the head goes after bit position 0 is written: the top of the ring when limited
+        # or -1 when unlimited, which grows the buffer on the next update.
+        self._wrap: int = (nwords << 6) - 1 if limit else -1
+        self._head: int = (nwords << 6) - length - 1
+        if self._head < 0:
+            self._head = self._wrap
+        # Counters are native ints to keep NumPy scalar arithmetic out of update(). They are converted to
+        # NumPy types where they are returned.
+        self.updates: int = length
+        self.hits: int = state.bit_count()
 
     def __len__(self) -> int:
         """Get the length of the history. The maximum length is the limit of the buffer.
         To get the total number of updates read the updates property.
         """
-        return (
-            int(self.updates)
-            if not self.limit
-            else int(minimum(self.updates, self.limit))
-        )
+        return min(self.updates, self.limit) if self.limit else self.updates
 
     def __repr__(self) -> str:
         """Get the representation of the history."""
@@ -43,9 +97,7 @@ class binary_history_buffer:
 
     def __getitem__(self, index: int | integer | slice) -> bool | Self:
         """Get the state of a bit in the history."""
-        limit: int = int(
-            minimum(self.updates, self.limit) if self.limit else self.updates
-        )
+        limit: int = min(self.updates, self.limit) if self.limit else self.updates
         if isinstance(index, slice):
             if not (index.step is None or index.step == 1):
                 raise ValueError(f"Slice step must be 1 or None not {index.step}")
@@ -68,20 +120,65 @@ class binary_history_buffer:
                 f"Index {index} is out of range for history of length {limit}"
             )
         if index < 0:
-            index = int(limit - index)
+            index = int(limit + index)
         return self._get_bit(index)
 
     def _get_bit(self, index: int | integer) -> bool:
         """Get the state of a bit in the history. Index must be in the range [0:limit]."""
-        return bool((self.buffer >> index) & 1)
+        position: int = (self._head + 1 + int(index)) % (self.buffer.size << 6)
+        return bool((int(self.buffer[position >> 6]) >> (position & 0x3F)) & 1)
+
+    def _segments(self, start: int, length: int) -> tuple[tuple[int, int], ...]:
+        """Map the history window [start:start + length] onto the buffer.
+
+        The window must be within the history. At most 2 segments are returned as a window in
+        a limited buffer may wrap around the end of the ring.
+
+        Returns
+        -------
+        ((buffer bit position, number of bits), ...) in order of increasing age.
+        """
+        return _ring_segments(self._head, self.buffer.size << 6, start, length)
+
+    def _popcount_range(self, start: int, length: int) -> int:
+        """Count the set bits in the history window [start:start + length].
+
+        The window must be within the history. Only the words covering the window are read and
+        only the partial words at either end are masked.
+        """
+        hits: int = 0
+        for position, nbits in self._segments(start, length):
+            if not nbits:
+                continue
+            first: int = position >> 6
+            last: int = (position + nbits - 1) >> 6
+            head: int = int(self.buffer[first]) >> (position & 0x3F)
+            if first == last:
+                hits += (head & _BIT_MASKS[nbits]).bit_count()
+            else:
+                tail: int = int(self.buffer[last]) & _BIT_MASKS[((position + nbits - 1) & 0x3F) + 1]
+                hits += head.bit_count() + tail.bit_count()
+                if last > first + 1:
+                    hits += int(bitwise_count(self.buffer[first + 1 : last]).sum())
+        return hits
+
+    def counts(self) -> tuple[uint64, uint64]:
+        """Get the total number of hits & updates for the entry.
+
+        Returns:
+            (Total True updates, Total updates)
+        """
+        return uint64(self.hits), uint64(self.updates)
 
     def totals(self) -> tuple[uint64, uint64, float64]:
         """Get the total number of hits, updates & the ratio for the entry.
 
         Returns:
-            (Total True updates, Total updates, Hit Ratio)
+            (Total True updates, Total updates, Hit Ratio). The ratio is NaN if there are no updates.
         """
-        return self.hits, self.updates, self.hits / self.updates
+        hits: uint64 = uint64(self.hits)
+        updates: uint64 = uint64(self.updates)
+        return hits, updates, hits / updates if self.updates else float64(nan)
 
     def as_int(self, start: int | integer = 0, length: int | integer = 0) -> int:
         """Return the history[start:length] as an integer.
@@ -106,16 +203,21 @@ class binary_history_buffer:
         if start < 0:
             raise ValueError(f"Start {start} must be >= 0")
 
-        limit: int = int(
-            minimum(self.updates, self.limit) if self.limit else self.updates
-        )
+        limit: int = min(self.updates, self.limit) if self.limit else self.updates
         if not length:
             length = limit
         if (start + length) > limit:
             _logger.debug("Reducing history length to fit buffer")
             length = int(limit - start)
         marker: int = 1 << int(length)
-        return int((marker - 1) & (self.buffer >> start) | marker)
+        history: int = 0
+        shift: int = 0
+        for position, nbits in self._segments(int(start), int(length)):
+            words: NDArray[uint64] = self.buffer[position >> 6 : (position + nbits + 63) >> 6]
+            bits: int = int.from_bytes(words.tobytes(), byteorder) >> (position & 0x3F)
+            history |= (bits & ((1 << nbits) - 1)) << shift
+            shift += nbits
+        return history | marker
 
     def as_str(self, start: int | integer = 0, length: int | integer = 0) -> str:
         """Return the history[start:length] as a string.
@@ -135,15 +237,24 @@ class binary_history_buffer:
         """
         if length < 0:  # 0 length history
             return ""
-        history: int = self.as_int(start, length)
-        limit: int = int(
-            minimum(self.updates, self.limit) if self.limit else self.updates
-        )
+        if start < 0:
+            raise ValueError(f"Start {start} must be >= 0")
+
+        limit: int = min(self.updates, self.limit) if self.limit else self.updates
+        if not length:
+            length = limit
         if (start + length) > limit:
             _logger.debug("Reducing history length to fit buffer")
-            length = int(limit - start)
-        print(f"History: {history:b}, Start: {start}, Length: {length}")
-        return f"{{:0{length}b}}".format(history)[1:]
+            length = max(0, int(limit - start))
+
+        # Unpack the bits of the words covering each segment (newest first) then reverse to oldest first.
+        segments: list[NDArray[uint8]] = []
+        for position, nbits in self._segments(int(start), int(length)):
+            words: NDArray[uint64] = self.buffer[position >> 6 : (position + nbits + 63) >> 6]
+            bits: NDArray[uint8] = unpackbits(words.astype("<u8", copy=False).view(uint8), bitorder="little")
+            segments.append(bits[position & 0x3F : (position & 0x3F) + nbits])
+        characters: NDArray[uint8] = concatenate(segments)[::-1] + uint8(ord("0"))
+        return characters.tobytes().decode("ascii")
 
     def history(self, start: int | integer = 0, length: int | integer = 0) -> Self:
         """Return a copy of the history[start:length].
@@ -163,6 +274,42 @@ class binary_history_buffer:
         -------
         A new binary_history_buffer with the requested history.
         """
+        if start >= 0 and length >= 0:
+            limit: int = min(self.updates, self.limit) if self.limit else self.updates
+            if not length or (start + length) > limit:
+                length = max(0, int(limit - start))
+            history: binary_history_buffer = binary_history_buffer(self.limit)
+            if not length:
+                return history
+
+            # Copy the words covering the window rather than rebuild them from an integer. The ring is a
+            # whole number of words so the words of a window that wraps join up end to start.
+            size: int = self.buffer.size << 6
+            position: int = (self._head + 1 + int(start)) % size
+            end: int = position + int(length)
+            words: NDArray[uint64]
+            if end > size:
+                words = concatenate((self.buffer[position >> 6 :], self.buffer[: (end - size + 63) >> 6]))
+            else:
+                words = self.buffer[position >> 6 : (end + 63) >> 6]
+            shift: int = position & 0x3F
+            if shift:
+                # Shift the window down so history bit start is bit 0 of the first word.
+                shifted: NDArray[uint64] = words >> uint64(shift)
+                shifted[:-1] |= words[1:] << uint64(64 - shift)
+                words = shifted[: (length + 63) >> 6]
+            elif end <= size:
+                words = words.copy()
+            words[-1] &= uint64(_BIT_MASKS[((length - 1) & 0x3F) + 1])
+
+            if self.limit:
+                history.buffer[: words.size] = words
+            else:
+                history.buffer = words
+            history._head = history._wrap  # History bit i is at buffer bit position i
+            history.updates = int(length)
+            history.hits = int(bitwise_count(words).sum())
+            return history
         return binary_history_buffer(self.limit, self.as_int(start, length))
 
     def history_totals(
@@ -182,17 +329,27 @@ class binary_history_buffer:
         -------
         (# True updates, # Updates, Ratio) for the history window.
         """
-        history: int = self.as_int(start, length)
-        hits: uint64 = uint64(history.bit_count() - 1)
-        bits: uint64 = uint64(length) if length >= 0 else uint64(0)
-        if _LOG_DEBUG:
+        if start < 0:
+            raise ValueError(f"Start {start} must be >= 0")
+
+        limit: int = min(self.updates, self.limit) if self.limit else self.updates
+        if length < 0:  # 0 length history
+            length = 0
+        elif not length or (start + length) > limit:
+            length = max(0, int(limit - start))
+
+        hits: uint64 = uint64(self._popcount_range(int(start), length))
+        bits: uint64 = uint64(length)
+        if __debug__ and _logger.isEnabledFor(DEBUG):
             _logger.debug(
-                f"History start {start}, length {length}, # hits {hits}, # bits {bits}, ratio {hits / bits}"
+                f"History start {start}, length {length}, # hits {hits}, # bits {bits}"
             )
-            for nbit in range(0, length, 64):
-                bit_str: str = f"{(history >> nbit) & ((1 << 64) - 1):064b}"
-                _logger.debug(f"History #{nbit:06d} {bit_str}")
-        return hits, bits, hits / bits
+            if length:  # as_int() reads a length of 0 as the whole history
+                history: int = self.as_int(start, length)
+                for nbit in range(0, length, 64):
+                    bit_str: str = f"{(history >> nbit) & _BIT_MASKS[64]:064b}"
+                    _logger.debug(f"History #{nbit:06d} {bit_str}")
+        return hits, bits, hits / bits if length else float64(nan)
 
     def update(self, value: bool) -> None:
         """Insert a new value into the entry history buffer.
@@ -200,11 +357,191 @@ class binary_history_buffer:
         Args:
             value (bool): The value to insert.
         """
-        self.buffer = (self.buffer << 1) | int(value)
-        if self.limit > 0:
-            self.buffer &= (1 << int(self.limit + 1)) - 1
+        head: int = self._head
+        if head < 0:
+            # Unlimited buffers double in size when full. The history moves to the top half.
+            head = (self.buffer.size << 6) - 1
+            self.buffer = concatenate((zeros(self.buffer.size, dtype=uint64), self.buffer))
+        if value:
+            self.buffer[head >> 6] |= _SET_BITS[head & 0x3F]
+            self.hits += 1
+        else:
+            self.buffer[head >> 6] &= _CLEAR_BITS[head & 0x3F]
+        self._head = head - 1 if head else self._wrap
+        self.updates += 1
+
+    def _write(self, top: int, values: NDArray[bool_]) -> None:
+        """Write values, oldest first, to the bit positions top, top - 1, ... top - len(values) + 1."""
+        bottom: int = top - len(values) + 1
+        first: int = bottom >> 6
+        last: int = top >> 6
+        bits: NDArray[uint8] = unpackbits(
+            self.buffer[first : last + 1].astype("<u8", copy=False).view(uint8), bitorder="little"
+        )
+        bits[bottom - (first << 6) : top - (first << 6) + 1] = values[::-1]
+        self.buffer[first : last + 1] = frombuffer(packbits(bits, bitorder="little").tobytes(), dtype="<u8")
+
+    def extend(self, values: ArrayLike) -> None:
+        """Insert a sequence of values into the history buffer.
+
+        Equivalent to inserting each value in turn with update() but the values are written
+        a word at a time.
+
+        Args:
+            values: The values to insert, oldest first.
+        """
+        _values: NDArray[bool_] = asarray(values, dtype=bool_).ravel()
+        nvalues: int = len(_values)
+        if not nvalues:
+            return
+        self.hits += int(count_nonzero(_values))
+        self.updates += nvalues
+        head: int = self._head
+        if not self.limit:
+            # Unlimited buffers double in size until the values fit, as if update() had been called for each.
+            while head + 1 < nvalues:
+                head += self.buffer.size << 6
+                self.buffer = concatenate((zeros(self.buffer.size, dtype=uint64), self.buffer))
+            self._write(head, _values)
+            self._head = head - nvalues
+            return
+
+        # Values older than a full ring are overwritten so only the most recent ring of values is written.
+        size: int = self.buffer.size << 6
+        if nvalues > size:
+            head = (head - (nvalues - size)) % size
+            _values = _values[-size:]
+        nbottom: int = min(len(_values), head + 1)  # Values written before the head wraps
+        self._write(head, _values[:nbottom])
+        if nbottom < len(_values):
+            self._write(size - 1, _values[nbottom:])
+        self._head = (head - len(_values)) % size
+
+
+class binary_history_buffer_array:
+    """Maintains the histories of an array of binary states that are updated together.
+
+    The buffers share the ring layout & head of binary_history_buffer. The buffer words of all the
+    entries are stored together so an update writes one contiguous column of words.
+    """
+
+    def __init__(self, size: int = 1, limit: int | integer = 0) -> None:
+        """Create an array of binary history buffers.
+
+        Args
+        ----
+
+        size: The number of buffers in the array.
+        limit: The maximum number of bits to store in each buffer. 0 = infinite.
+        """
+        nwords: int = (max(int(limit), 1) + 63) >> 6
+        self.limit: int = int(limit)
+        self.buffer: NDArray[uint64] = zeros((size, nwords), dtype=uint64, order="F")
+        self._wrap: int = (nwords << 6) - 1 if limit else -1
+        self._head: int = (nwords << 6) - 1
+        self.updates: int = 0
+        self.hits: NDArray[uint64] = zeros(size, dtype=uint64)
+
+    def __len__(self) -> int:
+        """Get the length of the history of each buffer."""
+        return min(self.updates, self.limit) if self.limit else self.updates
+
+    def counts(self) -> tuple[NDArray[uint64], uint64]:
+        """Get the total number of hits & updates for each buffer.
+
+        Returns:
+            (Total True updates, Total updates)
+        """
+        return self.hits.copy(), uint64(self.updates)
+
+    def totals(self) -> tuple[NDArray[uint64], uint64, NDArray[float64]]:
+        """Get the total number of hits, updates & the ratios for each buffer.
+
+        Returns:
+            (Total True updates, Total updates, Hit Ratios). The ratios are NaN if there are no updates.
+        """
+        updates: uint64 = uint64(self.updates)
+        return self.hits.copy(), updates, self.hits / updates if self.updates else full(self.hits.shape, nan)
+
+    def history(self, entry: int, start: int | integer = 0, length: int | integer = 0) -> binary_history_buffer:
+        """Return a copy of the history[start:length] of a buffer.
+
+        Args
+        ----
+        entry: The buffer to copy.
+        length: The length of bit history to copy. Defaults to 0 (all).
+        start: The starting bit position for the length. Defaults to 0.
+
+        Returns
+        -------
+        A new binary_history_buffer with the requested history.
+        """
+        history: binary_history_buffer = binary_history_buffer(self.limit)
+        history.buffer = self.buffer[entry].copy()
+        history._wrap = self._wrap
+        history._head = self._head
+        history.updates = self.updates
+        history.hits = int(self.hits[entry])
+        return history.history(start, length)
+
+    def history_totals(
+        self, start: int | integer, length: int | integer = 0
+    ) -> tuple[NDArray[uint64], uint64, NDArray[float64]]:
+        """Get the number of hits, updates & the ratios in the history window [start:length] of every buffer.
+
+        Args
+        ----
+        length: The length of bit history to evaluate. Defaults to 0 (all).
+        start: The starting bit position for the length. Defaults to 0.
+
+        Returns
+        -------
+        (# True updates, # Updates, Ratios) for the history window.
+        """
+        if start < 0:
+            raise ValueError(f"Start {start} must be >= 0")
+
+        limit: int = len(self)
+        if length < 0:  # 0 length history
+            length = 0
+        elif not length or (start + length) > limit:
+            length = max(0, int(limit - start))
+
+        hits: NDArray[uint64] = zeros(self.buffer.shape[0], dtype=uint64)
+        for position, nbits in _ring_segments(self._head, self.buffer.shape[1] << 6, int(start), length):
+            if not nbits:
+                continue
+            first: int = position >> 6
+            last: int = (position + nbits - 1) >> 6
+            head: NDArray[uint64] = self.buffer[:, first] >> uint64(position & 0x3F)
+            if first == last:
+                hits += bitwise_count(head & uint64(_BIT_MASKS[nbits]))
+            else:
+                tail: NDArray[uint64] = self.buffer[:, last] & uint64(_BIT_MASKS[((position + nbits - 1) & 0x3F) + 1])
+                hits += bitwise_count(head) + bitwise_count(tail)
+                if last > first + 1:
+                    hits += bitwise_count(self.buffer[:, first + 1 : last]).sum(axis=1, dtype=uint64)
+        bits: uint64 = uint64(length)
+        return hits, bits, hits / bits if length else full(self.hits.shape, nan)
+
+    def update(self, values: ArrayLike) -> None:
+        """Insert a new value into every buffer.
+
+        Args:
+            values: The values to insert. One per buffer.
+        """
+        head: int = self._head
+        if head < 0:
+            # Unlimited buffers double in size when full. The history moves to the top half.
+            head = (self.buffer.shape[1] << 6) - 1
+            self.buffer = asfortranarray(concatenate((zeros_like(self.buffer), self.buffer), axis=1))
+        _values: NDArray[uint64] = asarray(values, dtype=bool_).astype(uint64)
+        column: NDArray[uint64] = self.buffer[:, head >> 6]
+        column &= _CLEAR_BITS[head & 0x3F]
+        column |= _values << uint64(head & 0x3F)
+        self._head = head - 1 if head else self._wrap
         self.updates += 1
-        self.hits += int(value)
+        self.hits += _values
 
 
 # Aliases
@@ -212,3 +549,6 @@ class bhb(binary_history_buffer):
     """Alias for binary_history_buffer."""
 
     pass
+
+
+bhba = binary_history_buffer_array
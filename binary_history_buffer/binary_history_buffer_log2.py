@@ -1,16 +1,19 @@
 """Binary History Buffer."""
 
 from __future__ import annotations
-from typing import Any, Hashable
-from logging import DEBUG, Logger, NullHandler, getLogger
+from typing import Hashable
+from logging import Logger, NullHandler, getLogger
 
-from numpy import uint64, uint32, uint8, zeros, float64
-from numpy.typing import NDArray
+from numpy import uint64, bool_, zeros, float64, nan, asarray, intp, packbits, count_nonzero
+from numpy.typing import ArrayLike, NDArray
 
 
 _logger: Logger = getLogger(__name__)
 _logger.addHandler(NullHandler())
-_LOG_DEBUG: bool = _logger.isEnabledFor(DEBUG)
+
+
+# Number of entries update_all() processes at a time so a tile of each array stays in L2.
+_TILE_SIZE: int = 1 << 14
 
 
 class binary_history_buffer_log2_table:
@@ -35,7 +38,12 @@ class binary_history_buffer_log2_table:
         self.updates: NDArray[uint64] = zeros(self._size, dtype=uint64)
         self.hits: NDArray[uint64] = zeros(self._size, dtype=uint64)
         self.buffer: NDArray[uint64] = zeros(self._size, dtype=uint64)
-        self.lsbs: uint64 = uint64((1 << nlsb) - 1)
+        self._lsbs: int = (1 << nlsb) - 1
+
+    @property
+    def lsbs(self) -> uint64:
+        """The mask of the guaranteed set oldest (least significant) bits."""
+        return uint64(self._lsbs)
 
     def __getitem__(self, entry: int) -> binary_history_buffer_log2:
         """Get the fraction of True updates for each store.
@@ -55,9 +63,55 @@ class binary_history_buffer_log2_table:
             entry (int): The entry to insert the value into.
             value (bool): The value to insert.
         """
-        self.updates[entry] += uint64(1)
-        self.hits[entry] += uint64(value)
-        self.buffer[entry] = (self.buffer[entry] >> 1) | uint64(value << 63) | self.lsbs
+        # Python integer arithmetic avoids creating a NumPy scalar for every operand.
+        self.updates[entry] += 1
+        self.hits[entry] += value
+        self.buffer[entry] = (int(self.buffer[entry]) >> 1) | (int(value) << 63) | self._lsbs
+
+    def extend(self, entry: int, values: ArrayLike) -> None:
+        """Insert a sequence of values into the entry history buffer.
+
+        Equivalent to inserting each value in turn but the buffer is only shifted once.
+
+        Args:
+            entry (int): The entry to insert the values into.
+            values: The values to insert, oldest first.
+        """
+        _values: NDArray[bool_] = asarray(values, dtype=bool_).ravel()
+        nvalues: int = len(_values)
+        if not nvalues:
+            return
+        # Only the most recent 64 values remain in the buffer. The newest is the MSb.
+        recent: NDArray[bool_] = _values[-64:]
+        word: int = int.from_bytes(packbits(recent, bitorder="little").tobytes(), "little")
+        shifted: int = int(self.buffer[entry]) >> nvalues if nvalues < 64 else 0
+        self.updates[entry] += nvalues
+        self.hits[entry] += int(count_nonzero(_values))
+        self.buffer[entry] = shifted | (word << (64 - len(recent))) | self._lsbs
+
+    def update_all(self, values: ArrayLike, entries: ArrayLike | None = None) -> None:
+        """Insert a new value into the history buffer of every entry in one vectorized pass.
+
+        Args:
+            values: The values to insert. One per entry in the table or per entry in entries.
+            entries: The unique entries to insert the values into. Defaults to None (all entries).
+        """
+        if entries is None:
+            _all_values: NDArray[bool_] = asarray(values, dtype=bool_)
+            for tile in range(0, self._size, _TILE_SIZE):
+                chunk: slice = slice(tile, tile + _TILE_SIZE)
+                _values: NDArray[uint64] = _all_values[chunk].astype(uint64)
+                self.updates[chunk] += uint64(1)
+                self.hits[chunk] += _values
+                buffer: NDArray[uint64] = self.buffer[chunk]
+                buffer >>= uint64(1)
+                buffer |= (_values << uint64(63)) | self.lsbs
+        else:
+            _values = asarray(values, dtype=bool_).astype(uint64)
+            _entries: NDArray[intp] = asarray(entries, dtype=intp)
+            self.updates[_entries] += uint64(1)
+            self.hits[_entries] += _values
+            self.buffer[_entries] = (self.buffer[_entries] >> uint64(1)) | (_values << uint64(63)) | self.lsbs
 
     def ratios(self) -> NDArray[float64]:
         """Return the normalized weighted history ratios."""
@@ -65,7 +119,12 @@ class binary_history_buffer_log2_table:
 
 
 class mapped_binary_history_buffer_log2_table(binary_history_buffer_log2_table):
-    """Maps a key to a binary history buffer log2 table entry."""
+    """Maps a key to a binary history buffer log2 table entry.
+
+    Keys are mapped to entries in the order they are first used. Hot loops updating
+    the same keys repeatedly should look up the entry once with index_of() and
+    use update_by_index() to skip the key lookup.
+    """
 
     def __init__(self, size: int = 1, nlsb: int = 0) -> None:
         """Create a binary history buffer log2 table with a key index.
@@ -86,7 +145,7 @@ class mapped_binary_history_buffer_log2_table(binary_history_buffer_log2_table):
         Returns:
             The binary history buffer.
         """
-        return super()[self._keys[key]]
+        return super().__getitem__(self._keys[key])
 
     def __setitem__(self, key: Hashable, value: bool) -> None:
         """Insert a new value into the entry history buffer.
@@ -95,7 +154,33 @@ class mapped_binary_history_buffer_log2_table(binary_history_buffer_log2_table):
             key: The key of the buffer to insert the value into.
             value (bool): The value to insert.
         """
-        super()[self._keys[key]] = value
+        super().__setitem__(self.index_of(key), value)
+
+    def index_of(self, key: Hashable) -> int:
+        """Get the table entry of the key mapping it to the next unused entry if it is new.
+
+        Args:
+            key: The key of the buffer.
+
+        Returns:
+            The table entry of the key.
+        """
+        index: int | None = self._keys.get(key)
+        if index is None:
+            index = len(self._keys)
+            if index >= self._size:
+                raise IndexError(f"All {self._size} table entries are mapped to keys.")
+            self._keys[key] = index
+        return index
+
+    def update_by_index(self, index: int, value: bool) -> None:
+        """Insert a new value into the history buffer of a table entry.
+
+        Args:
+            index: The table entry as returned by index_of().
+            value (bool): The value to insert.
+        """
+        super().__setitem__(index, value)
 
 
 class binary_history_buffer_log2:
@@ -115,15 +200,23 @@ class binary_history_buffer_log2:
         )
         self._entry: int = entry
 
+    def counts(self) -> tuple[uint64, uint64]:
+        """Get the total number of hits & updates for the entry.
+
+        Returns:
+            (Total True updates, Total updates)
+        """
+        return self._bhbl2t.hits[self._entry], self._bhbl2t.updates[self._entry]
+
     def totals(self) -> tuple[uint64, uint64, float64]:
         """Get the total number of hits, updates & the ratio for the entry.
 
         Returns:
-            (Total True updates, Total updates, Hit Ratio)
+            (Total True updates, Total updates, Hit Ratio). The ratio is NaN if there are no updates.
         """
         hits: uint64 = self._bhbl2t.hits[self._entry]
         updates: uint64 = self._bhbl2t.updates[self._entry]
-        ratio: float64 = hits / updates
+        ratio: float64 = hits / updates if updates else float64(nan)
         return hits, updates, ratio
 
     def history(self) -> tuple[uint64, uint64, float64]:
@@ -138,7 +231,7 @@ class binary_history_buffer_log2:
         buffer: uint64 = self._bhbl2t.buffer[self._entry]
         updates: uint64 = min(self._bhbl2t.updates[self._entry], uint64(64))
         hits = uint64(buffer.bit_count())
-        return hits, updates, hits / updates
+        return hits, updates, hits / updates if updates else float64(nan)
 
     def update(self, value: bool) -> None:
         """Insert a new value into the entry history buffer.
@@ -146,7 +239,16 @@ class binary_history_buffer_log2:
         Args:
             value (bool): The value to insert.
         """
-        self._bhbl2t[self._entry] = value
+        # Write by entry index: the table may be a mapped table whose __setitem__ takes a key.
+        binary_history_buffer_log2_table.__setitem__(self._bhbl2t, self._entry, value)
+
+    def extend(self, values: ArrayLike) -> None:
+        """Insert a sequence of values into the entry history buffer.
+
+        Args:
+            values: The values to insert, oldest first.
+        """
+        self._bhbl2t.extend(self._entry, values)
 
 
 # Aliases
@@ -1,116 +1,404 @@
 """Binary History Buffer."""
 
 from __future__ import annotations
-from typing import Any
+from bisect import bisect_left
 from logging import DEBUG, Logger, NullHandler, getLogger
 
 from numpy import (
     int64,
     uint64,
-    integer,
-    uint8,
-    int8,
+    bool_,
     zeros,
-    signedinteger,
     float64,
-    arange,
-    power,
-    cumsum,
-    log2,
+    nan,
+    array,
+    asarray,
+    intp,
+    searchsorted,
+    zeros_like,
 )
-from numpy.typing import NDArray
+from numpy.typing import ArrayLike, NDArray
 
-from .binary_history_buffer import binary_history_buffer
-from .binary_history_buffer_log2 import 
 
 _logger: Logger = getLogger(__name__)
 _logger.addHandler(NullHandler())
-_LOG_DEBUG: bool = _logger.isEnabledFor(DEBUG)
+_MASK64: int = (1 << 64) - 1
 
+# Number of entries update_many() inserts all the values into at a time so the state of a tile stays in L2.
+_TILE_SIZE: int = 1 << 13
 
-class binary_history_buffer_z(binary_history_buffer):
+
+def _z_shift(
+    stores: list[int], carry: int, hold: int, hold_valid: int, value: bool, nfull: int
+) -> tuple[int, int, int]:
+    """Shift a value into the stores of an entry cascading the evicted bits through the stores.
+
+    The carry, hold & hold valid bits of every store are packed one bit per store so the
+    state of all the stores is updated with a handful of bitwise operations.
+
+    Args:
+        stores: The stores of the entry. Updated in place.
+        carry: The entry carry bits.
+        hold: The entry hold bits.
+        hold_valid: The entry hold valid bits.
+        value: The value to insert.
+        nfull: The number of full stores in the entry i.e. stores that evict a bit when shifted.
+
+    Returns:
+        (carry, hold, hold valid) bits of the entry after the shift.
+    """
+    # Full stores with a valid hold bit pair it with the evicted bit and shift a bit into the next
+    # store. The stores that shift are 0 to the first store that does not pair, inclusive.
+    pairing: int = ((1 << nfull) - 1) & hold_valid
+    npairing: int = (~pairing & (pairing + 1)).bit_length() - 1
+    nshift: int = min(npairing + 1, len(stores))
+    evicted: int = 0
+    for idx in range(nshift):
+        evicted |= (stores[idx] >> 63) << idx
+
+    # The pair & carry bit sum to 0-3: the MSb shifts into the next store and the LSb is the new carry.
+    paired: int = (1 << npairing) - 1
+    held: int = (1 << npairing) if npairing < nfull else 0
+    majority: int = (hold & evicted) | (hold & carry) | (evicted & carry)
+    bits: int = int(value) | ((majority & paired) << 1)
+    for idx in range(nshift):
+        stores[idx] = ((stores[idx] << 1) & _MASK64) | ((bits >> idx) & 1)
+    return (
+        (carry & ~paired) | ((hold ^ evicted ^ carry) & paired),
+        (hold & ~paired) | (evicted & held),
+        (hold_valid & ~paired) | held,
+    )
+
+
+def _z_setitem(
+    buffer: NDArray[uint64],
+    carry: NDArray[uint64],
+    hold: NDArray[uint64],
+    hold_valid: NDArray[uint64],
+    entry: int,
+    value: bool,
+    nfull: int,
+) -> None:
+    """Shift a value into the stores of an entry of a table.
+
+    Args:
+        buffer: The table stores.
+        carry: The table carry bits.
+        hold: The table hold bits.
+        hold_valid: The table hold valid bits.
+        entry: The entry to insert the value into.
+        value: The value to insert.
+        nfull: The number of full stores in the entry i.e. stores that evict a bit when shifted.
+    """
+    stores: list[int] = buffer[entry].tolist()
+    carry[entry], hold[entry], hold_valid[entry] = _z_shift(
+        stores, int(carry[entry]), int(hold[entry]), int(hold_valid[entry]), value, nfull
+    )
+    buffer[entry] = stores
+
+
+def _z_extend(
+    buffer: NDArray[uint64],
+    carry: NDArray[uint64],
+    hold: NDArray[uint64],
+    hold_valid: NDArray[uint64],
+    entry: int,
+    values: list[bool],
+    updates: int,
+    full_after: list[int],
+) -> None:
+    """Shift a sequence of values into the stores of an entry of a table.
+
+    The entry state is read once, kept in Python integers for all the values & written back once.
+
+    Args:
+        buffer: The table stores.
+        carry: The table carry bits.
+        hold: The table hold bits.
+        hold_valid: The table hold valid bits.
+        entry: The entry to insert the values into.
+        values: The values to insert, oldest first.
+        updates: The number of updates of the entry before the values are inserted.
+        full_after: Store N is full once the entry has more than full_after[N] updates.
+    """
+    stores: list[int] = buffer[entry].tolist()
+    _carry: int = int(carry[entry])
+    _hold: int = int(hold[entry])
+    _hold_valid: int = int(hold_valid[entry])
+    nfull: int = bisect_left(full_after, updates)
+    limit: int = full_after[nfull] if nfull < len(full_after) else -1
+    for value in values:
+        updates += 1
+        if updates > limit >= 0:
+            nfull = bisect_left(full_after, updates)
+            limit = full_after[nfull] if nfull < len(full_after) else -1
+        _carry, _hold, _hold_valid = _z_shift(stores, _carry, _hold, _hold_valid, value, nfull)
+    buffer[entry] = stores
+    carry[entry] = _carry
+    hold[entry] = _hold
+    hold_valid[entry] = _hold_valid
+
+
+def _z_update_all(
+    buffer: NDArray[uint64],
+    carry: NDArray[uint64],
+    hold: NDArray[uint64],
+    hold_valid: NDArray[uint64],
+    values: NDArray[uint64],
+    full: NDArray[uint64],
+) -> None:
+    """Shift a value into the stores of every entry with the operations of _z_shift() vectorized across entries.
+
+    Args:
+        buffer: The stores of the entries. Updated in place.
+        carry: The entry carry bits. Updated in place.
+        hold: The entry hold bits. Updated in place.
+        hold_valid: The entry hold valid bits. Updated in place.
+        values: The values to insert, 0 or 1, one per entry.
+        full: The full stores of each entry i.e. bit N is set if store N evicts a bit when shifted.
+    """
+    if not len(values):
+        return
+
+    # paired has the bits of the stores that pair set & next the bit of the first store that does not.
+    # Stores 0 to next inclusive shift.
+    pairing: NDArray[uint64] = full & hold_valid
+    paired: NDArray[uint64] = (pairing ^ (pairing + 1)) >> 1
+    _next: NDArray[uint64] = paired + 1
+    held: NDArray[uint64] = _next & full
+    nshift: int = min(int((paired | _next).max()).bit_length(), buffer.shape[1])
+    evicted: NDArray[uint64] = zeros_like(carry)
+    for idx in range(nshift):
+        evicted |= (buffer[:, idx] >> 63) << idx
+
+    majority: NDArray[uint64] = (hold & evicted) | (hold & carry) | (evicted & carry)
+    bits: NDArray[uint64] = values | ((majority & paired) << 1)
+    carry[:] = (carry & ~paired) | ((hold ^ evicted ^ carry) & paired)
+    hold[:] = (hold & ~paired) | (evicted & held)
+    hold_valid[:] = (hold_valid & ~paired) | held
+
+    # Bits only has bits set for stores that shift so a store shifts by its bit of (paired | next).
+    shift: NDArray[uint64] = paired | _next
+    for idx in range(nshift):
+        buffer[:, idx] = (buffer[:, idx] << ((shift >> idx) & 1)) | ((bits >> idx) & 1)
+
+
+class binary_history_buffer_z_table:
+    """Maintains compressed histories of binary states.
+
+    See https://github.com/Shapedsundew9/binary-history-buffer/blob/main/README.md for details.
+    """
+
+    def __init__(self, size: int = 1, length: int = 6) -> None:
+        """Create a table of compressed binary history buffers.
+
+        Args:
+            size: Number of buffers to maintain in the table. Defaults to 1.
+            length: Number of 64 bit stores in each buffer, at most 64. Store N has a fidelity of 2**N. Defaults to 6.
+        """
+        if length > 64:
+            raise ValueError(f"Length {length} must be <= 64. The store state bit maps have 1 bit per store.")
+        self._size: int = size
+        self._length: int = length
+
+        # Member descriptions:
+        # updates: The total number of updates for each entry i.e. the number of bits in the history.
+        # hits: The total number of True updates for each entry.
+        # buffer: The history stores. The most recent state is the LSb of store 0.
+        # _carry, _hold, _hold_valid: The carry, hold & hold valid bits of each entry. Bit N is store N. See README.md.
+        self.updates: NDArray[uint64] = zeros(self._size, dtype=uint64)
+        self.hits: NDArray[uint64] = zeros(self._size, dtype=uint64)
+        # Store columns are contiguous for update_all(). Reading a row of a few stores per entry costs the same either way.
+        self.buffer: NDArray[uint64] = zeros((self._size, self._length), dtype=uint64, order="F")
+        self._carry: NDArray[uint64] = zeros(self._size, dtype=uint64)
+        self._hold: NDArray[uint64] = zeros(self._size, dtype=uint64)
+        self._hold_valid: NDArray[uint64] = zeros(self._size, dtype=uint64)
+
+        # Store N is full once the entry has more than _full_after[N] updates. Store N + 1 has
+        # (n - 64) // 2 bits inserted when store N has had n so _full_after[N] = 129 * 2**N - 65.
+        self._full_after: list[int] = [129 * (1 << n) - 65 for n in range(self._length)]
+        # _full_after as uint64 for searchsorted() in the vectorized updates. Stores that cannot fill
+        # before the update count overflows are clamped to the maximum count.
+        self._full_after_array: NDArray[uint64] = array([min(n, _MASK64) for n in self._full_after], dtype=uint64)
+
+        # _full_masks[N] has the bits of the first N stores set i.e. the full stores when N stores are full.
+        self._full_masks: NDArray[uint64] = array([(1 << n) - 1 for n in range(self._length + 1)], dtype=uint64)
+
+    def __getitem__(self, entry: int) -> binary_history_buffer_z:
+        """Get the binary history buffer for an entry.
+
+        Args:
+            entry (int): The entry to get.
+
+        Returns:
+            The binary history buffer entry.
+        """
+        return binary_history_buffer_z(self, entry)
+
+    def __setitem__(self, entry: int, value: bool) -> None:
+        """Insert a new value into the entry history buffer.
+
+        The value is shifted into store 0. Once a store is full the bits shifted out of it
+        are paired up and, with the carry bit, determine the bit shifted into the next store.
+
+        Args:
+            entry (int): The entry to insert the value into.
+            value (bool): The value to insert.
+        """
+        updates: int = int(self.updates[entry]) + 1  # Read once & kept as a Python int for bisect_left()
+        self.updates[entry] = updates
+        self.hits[entry] += value
+        nfull: int = bisect_left(self._full_after, updates)
+        _z_setitem(self.buffer, self._carry, self._hold, self._hold_valid, entry, value, nfull)
+
+    def extend(self, entry: int, values: ArrayLike) -> None:
+        """Insert a sequence of values into the entry history buffer.
+
+        Equivalent to inserting each value in turn but the entry state is only read & written once.
+
+        Args:
+            entry (int): The entry to insert the values into.
+            values: The values to insert, oldest first.
+        """
+        _values: list[bool] = asarray(values, dtype=bool).tolist()
+        updates: int = int(self.updates[entry])
+        _z_extend(
+            self.buffer, self._carry, self._hold, self._hold_valid, entry, _values, updates, self._full_after
+        )
+        self.updates[entry] += len(_values)
+        self.hits[entry] += sum(_values)
+
+    def update_many(self, values: ArrayLike) -> None:
+        """Insert a sequence of values into the history buffer of every entry.
+
+        Equivalent to calling update_all() with each row of values in turn but the table is worked
+        through in tiles of entries, inserting all the values into a tile before moving to the next,
+        so the state of the tile stays in cache.
+
+        Args:
+            values: The values to insert with shape (# values, table size), oldest first.
+        """
+        _all_values: NDArray[bool_] = asarray(values, dtype=bool_)
+        for tile in range(0, self._size, _TILE_SIZE):
+            chunk: slice = slice(tile, tile + _TILE_SIZE)
+            _values: NDArray[uint64] = _all_values[:, chunk].astype(uint64)
+            updates: NDArray[uint64] = self.updates[chunk]
+            hits: NDArray[uint64] = self.hits[chunk]
+            buffer: NDArray[uint64] = self.buffer[chunk]
+            carry: NDArray[uint64] = self._carry[chunk]
+            hold: NDArray[uint64] = self._hold[chunk]
+            hold_valid: NDArray[uint64] = self._hold_valid[chunk]
+            for row in _values:
+                updates += uint64(1)
+                hits += row
+                full: NDArray[uint64] = self._full_masks[searchsorted(self._full_after_array, updates)]
+                _z_update_all(buffer, carry, hold, hold_valid, row, full)
+
+    def update_all(self, values: ArrayLike, entries: ArrayLike | None = None) -> None:
+        """Insert a new value into the history buffer of every entry in one vectorized pass.
+
+        Args:
+            values: The values to insert. One per entry in the table or per entry in entries.
+            entries: The unique entries to insert the values into. Defaults to None (all entries).
+        """
+        _values: NDArray[uint64] = asarray(values, dtype=bool).astype(uint64)
+        if entries is None:
+            self.updates += uint64(1)
+            self.hits += _values
+            full: NDArray[uint64] = self._full_masks[searchsorted(self._full_after_array, self.updates)]
+            _z_update_all(self.buffer, self._carry, self._hold, self._hold_valid, _values, full)
+        else:
+            _entries: NDArray[intp] = asarray(entries, dtype=intp)
+            self.updates[_entries] += uint64(1)
+            self.hits[_entries] += _values
+            full = self._full_masks[searchsorted(self._full_after_array, self.updates[_entries])]
+            buffer: NDArray[uint64] = self.buffer[_entries]
+            carry: NDArray[uint64] = self._carry[_entries]
+            hold: NDArray[uint64] = self._hold[_entries]
+            hold_valid: NDArray[uint64] = self._hold_valid[_entries]
+            _z_update_all(buffer, carry, hold, hold_valid, _values, full)
+            self.buffer[_entries] = buffer
+            self._carry[_entries] = carry
+            self._hold[_entries] = hold
+            self._hold_valid[_entries] = hold_valid
+
+
+class binary_history_buffer_z:
     """Maintains a compressed history of a binary state."""
 
-    def __init__(self, limit: int | integer = 0) -> None:
+    def __init__(
+        self, bhbzt: binary_history_buffer_z_table | None = None, entry: int = 0
+    ) -> None:
         """Create a compressed binary history buffer.
 
-        Args
-        ----
+        Args:
+            bhbzt: The table to use. If None a single entry table is created.
+            entry: The entry to use. Defaults to 0.
+        """
+        self._bhbzt: binary_history_buffer_z_table = (
+            bhbzt if bhbzt is not None else binary_history_buffer_z_table()
+        )
+        self._entry: int = entry
+        if __debug__ and _logger.isEnabledFor(DEBUG):
+            _logger.debug(
+                f"Entry {entry} of a {self._bhbzt._size} buffer table with {self._bhbzt._length} stores"
+            )
+
+    def counts(self) -> tuple[uint64, uint64]:
+        """Get the total number of hits & updates for the entry.
 
-        limit: The maximum number of bits to store in the buffer. 0 = infinite.
+        Returns:
+            (Total True updates, Total updates)
         """
-        self.limit: uint64 = uint64(limit)
-        self.updates: uint64 = uint64(0)
-        self.hits: uint64 = uint64(0)
-        self._size: int = int(log2(limit)) - 5 if limit else 58
-        self._last_index = 0
-        self._last_index_updates: uint64 = uint64(0)
-        self._hits: NDArray[uint64] = zeros(self._size, dtype=int8)
-        self._bits: NDArray[uint64] = zeros(self._size, dtype=int8)
-        self._data: NDArray[uint64] = zeros(self._size, dtype=int8)
-        self._buffer: NDArray[uint64] = zeros(self._size, dtype=uint64)
-        print(self)
-
-    def _get_bit(self, index: int | integer) -> bool:
-        """Get the state of a bit in the history."""
-        if index < 0:
-            index = max(0, self._last_index + index)
-        elif index > self._last_index:
-            index = self._last_index
-        return bool(self._buffer[index >> 6] & (1 << (index & 0x3F)))
+        return self._bhbzt.hits[self._entry], self._bhbzt.updates[self._entry]
 
     def totals(self) -> tuple[uint64, uint64, float64]:
         """Get the total number of hits, updates & the ratio for the entry.
 
         Returns:
-            (Total True updates, Total updates, Hit Ratio)
+            (Total True updates, Total updates, Hit Ratio). The ratio is NaN if there are no updates.
         """
-        hits: uint64 = self._bhbl2t.hits[self._entry]
-        updates: uint64 = self._bhbl2t.updates[self._entry]
-        ratio: float64 = hits / updates
+        hits: uint64 = self._bhbzt.hits[self._entry]
+        updates: uint64 = self._bhbzt.updates[self._entry]
+        ratio: float64 = hits / updates if updates else float64(nan)
         return hits, updates, ratio
 
-    def histories(self) -> tuple[NDArray[uint64], NDArray[uint64], NDArray[float64]]:
-        """Get the fraction of True updates for each history period.
-
-        Args:
-            length: The length of bit history to evaluate.
+    def histories(self) -> tuple[NDArray[int64], NDArray[int64], NDArray[float64]]:
+        """Get the hits, updates & hit ratio of the history up to the end of each store.
 
         Returns:
-            (Hit Ratios, History lengths)
+            (# True updates, # Updates, Ratios). A ratio is NaN if there is no history to the end of the store.
         """
-        updates: uint64 = self._bhbl2t.updates[self._entry]
-        data: NDArray[uint8] = self._bhbl2t._data[self._entry]
-        hold_valid: NDArray[signedinteger[Any]] = data >> 2
-        hold: NDArray[signedinteger[Any]] = (data >> 1) & hold_valid
-        carry: NDArray[signedinteger[Any]] = data & 0x1
-        fidelity: NDArray[int64] = power(2, arange(self._bhbl2t._length))
-        store_lengths = (
-            64 + carry + hold_valid
-        ) * fidelity  # Store may be 64, 65 or 66 bits long scaled by fidelity
-        total_bits: NDArray[uint64] = cumsum(store_lengths)
-        valid_stores = total_bits <= updates
-        last_index: int = valid_stores.sum()
-        if last_index < self._bhbl2t._length:
-            total_bits[last_index:] = updates
-        hits: NDArray[signedinteger[Any]] = (
-            self._bhbl2t._hits[self._entry] + carry + hold
-        )
-        total_hits: NDArray[uint64] = cumsum(hits * fidelity)
-        if _LOG_DEBUG:
-            for s, hv, h, c, th, tb, r in zip(
-                self._bhbl2t.buffer[self._entry],
-                hold_valid,
-                hold,
-                carry,
-                total_hits,
-                total_bits,
-                total_hits / total_bits,
-            ):
+        # One pass over the stores accumulating in Python integers: the number of stores is small
+        # so this is faster than a chain of NumPy operations each creating a temporary array.
+        updates: int = int(self._bhbzt.updates[self._entry])
+        carry: int = int(self._bhbzt._carry[self._entry])
+        hold: int = int(self._bhbzt._hold[self._entry])
+        hold_valid: int = int(self._bhbzt._hold_valid[self._entry])
+        total_hits: list[int] = []
+        total_bits: list[int] = []
+        ratios: list[float] = []
+        nhits: int = 0
+        nbits: int = 0
+        stores: list[int] = self._bhbzt.buffer[self._entry].tolist()
+        for idx, store in enumerate(stores):
+            c: int = (carry >> idx) & 1
+            hv: int = (hold_valid >> idx) & 1
+            h: int = (hold >> idx) & hv
+            nhits += (store.bit_count() + c + h) << idx  # Store N has a fidelity of 2**N
+            nbits += (64 + c + hv) << idx  # Store may be 64, 65 or 66 bits long
+            bits: int = min(nbits, updates)
+            total_hits.append(nhits)
+            total_bits.append(bits)
+            ratios.append(nhits / bits if bits else nan)  # NaN where the store has no history
+        if __debug__ and _logger.isEnabledFor(DEBUG):
+            for idx, (store, th, tb, r) in enumerate(zip(stores, total_hits, total_bits, ratios)):
+                hv = (hold_valid >> idx) & 1
                 _logger.debug(
-                    f"Store: {s:064b}, HV: {hv}, H: {h}, C: {c}, # hits {th}, # bits {tb}, ratio {r}"
+                    f"Store: {store:064b}, HV: {hv}, H: {(hold >> idx) & hv}, C: {(carry >> idx) & 1}, "
+                    f"# hits {th}, # bits {tb}, ratio {r}"
                 )
-        return total_hits, total_bits, total_hits / total_bits
+        return array(total_hits, dtype=int64), array(total_bits, dtype=int64), array(ratios, dtype=float64)
 
     def update(self, value: bool) -> None:
         """Insert a new value into the entry history buffer.
@@ -118,7 +406,15 @@ class binary_history_buffer_z(binary_history_buffer):
         Args:
             value (bool): The value to insert.
         """
-        self._bhbl2t[self._entry] = value
+        self._bhbzt[self._entry] = value
+
+    def extend(self, values: ArrayLike) -> None:
+        """Insert a sequence of values into the entry history buffer.
+
+        Args:
+            values: The values to insert, oldest first.
+        """
+        self._bhbzt.extend(self._entry, values)
 
 
 # Aliases
@@ -1,3 +1,4 @@
+from importlib import import_module
 from logging import DEBUG, Logger, NullHandler, getLogger
 from random import randint, seed
 from typing import LiteralString, cast
@@ -5,15 +6,17 @@ from warnings import catch_warnings, simplefilter
 
 import matplotlib.pyplot as plt
 import pytest
-from numpy import NAN, array, float64, int64, isclose, isnan, uint64, zeros
+from numpy import nan, array, bitwise_count, float64, frombuffer, int64, isclose, isnan, uint8, uint64, zeros
 from numpy.random import Generator, default_rng, normal
+from numpy.typing import NDArray
 
-from binary_history_buffer import bhb
+from binary_history_buffer import bhb, bhba, bhbz
+from binary_history_buffer.binary_history_buffer_log2 import bhbl2t, mapped_binary_history_buffer_log2_table
+from binary_history_buffer.binary_history_buffer_z import bhbzt
 
 
 _logger: Logger = getLogger(__name__)
 _logger.addHandler(NullHandler())
-_LOG_DEBUG: bool = _logger.isEnabledFor(DEBUG)
 
 
 # (limit, pattern, length)
@@ -97,6 +100,10 @@ TEST_GET_INDEX_PATTERNS: tuple[tuple[int, str, int, bool], ...] = (
     (4096, "1" * 3578, 3577, False),
     (1000, "0" * 1017, 1016, True),
     (1000, "1" * 3578, 3577, True),
+    (10, "100000", -1, False),
+    (10, "100001", -6, False),
+    (0, "000001", -6, False),
+    (3, "100001", -4, True),
 )
 # (limit, pattern, start, stop, exception)
 TEST_GET_SLICE_PATTERNS: tuple[tuple[int, str, int, int, bool], ...] = (
@@ -160,6 +167,13 @@ TEST_LF_RND_PATTERNS: list[LiteralString] = [
     )
     for _ in range(32)
 ]
+# The random patterns as arrays of 0 & 1 values for extend()
+TEST_HF_RND_BITS: list[NDArray[uint8]] = [
+    frombuffer(pattern.encode(), dtype=uint8) - ord("0") for pattern in TEST_HF_RND_PATTERNS
+]
+TEST_LF_RND_BITS: list[NDArray[uint8]] = [
+    frombuffer(pattern.encode(), dtype=uint8) - ord("0") for pattern in TEST_LF_RND_PATTERNS
+]
 
 
 @pytest.mark.parametrize("limit, pattern, length", TEST_LEN_PATTERNS)
@@ -245,16 +259,16 @@ def test_bhb_getitem_slice(
         assert cast(bhb, bhb64[start:stop]).as_str() == pattern[::-1][start:stop][::-1]
 
 
-@pytest.mark.parametrize("pattern", TEST_HF_RND_PATTERNS)
-def test_bhb_rnd_patterns(pattern) -> None:
+@pytest.mark.parametrize("pattern, bits", tuple(zip(TEST_HF_RND_PATTERNS, TEST_HF_RND_BITS)))
+def test_bhb_rnd_patterns(pattern, bits) -> None:
     """Test random patterns."""
     bhb64 = bhb()
-    for bit in pattern:
-        bhb64.update(bit == "1")
+    bhb64.extend(bits)
     hits, updates, ratio = bhb64.totals()
 
-    # Check total stats
+    # Check total stats. The unlimited buffer holds every update so its popcount is the hit count.
     assert hits == pattern.count("1")
+    assert hits == bitwise_count(bhb64.buffer).sum()
     assert updates == len(pattern)
     assert isclose(ratio, pattern.count("1") / len(pattern))
 
@@ -265,10 +279,10 @@ def test_bhb_rnd_patterns(pattern) -> None:
     hits: uint64 = uint64(pattern.count("1"))
     updates: uint64 = uint64(length)
     ratio: float64 = (
-        hits / updates if updates else float64(NAN)
+        hits / updates if updates else float64(nan)
     )  # Avoid the runtime warning
 
-    if _LOG_DEBUG:
+    if __debug__ and _logger.isEnabledFor(DEBUG):
         value: int = int(pattern, 2) if pattern else 0
         _logger.debug(f"Random Test Pattern:")
         _logger.debug(
@@ -298,31 +312,253 @@ def test_bhb_rnd_patterns(pattern) -> None:
         assert bhb64.history_totals(start, length) == (hits, updates, ratio)
 
 
+@pytest.mark.parametrize("limit", (0, 64, 100, 1000))
+def test_bhb_history_windows(limit: int) -> None:
+    """Test history windows at every bit offset, including windows that wrap the ring, against as_str()."""
+    bhb64 = bhb(limit)
+    bhb64.extend(TEST_LF_RND_BITS[0][:1500])
+    history_length: int = len(bhb64)
+    for start in range(0, history_length + 2, 7):
+        for length in (1, 63, 64, 65, 130, history_length):
+            window = bhb64.history(start, length)
+            assert window.as_str() == bhb64.as_str(start, length)
+            assert window.totals()[:2] == bhb64.history_totals(start, length)[:2]
+
+
+@pytest.mark.parametrize("limit", (0, 5))
+def test_bhb_history_totals_past_end(limit: int, caplog: pytest.LogCaptureFixture) -> None:
+    """Test a history window starting past the end of the history is empty with debug logging on."""
+    caplog.set_level(DEBUG, logger="binary_history_buffer.binary_history_buffer")
+    bhb64 = bhb(limit)
+    bhb64.extend([1] * 10)
+    hits, updates, ratio = bhb64.history_totals(20)
+    assert hits == 0
+    assert updates == 0
+    assert isnan(ratio)
+
+
+@pytest.mark.parametrize("limit", (0, 1, 63, 64, 100, 1000))
+def test_bhb_extend(limit: int) -> None:
+    """Test extending a bhb matches updating it one value at a time."""
+    bhb64 = bhb(limit)
+    bhb64_updated = bhb(limit)
+    for pattern, bits in zip(TEST_LF_RND_PATTERNS[:4], TEST_LF_RND_BITS[:4]):
+        bhb64.extend(bits)
+        for bit in pattern:
+            bhb64_updated.update(bit == "1")
+        assert bhb64.totals() == bhb64_updated.totals()
+        assert bhb64.as_str() == bhb64_updated.as_str()
+
+
+@pytest.mark.parametrize("limit", (0, 100, 1000))
+def test_bhba_rnd_patterns(limit: int) -> None:
+    """Test bhba matches a bhb per entry."""
+    patterns: list[LiteralString] = TEST_LF_RND_PATTERNS[:8]
+    length: int = min(len(pattern) for pattern in patterns)
+    bhba64 = bhba(len(patterns), limit)
+    bhbs: list[bhb] = [bhb(limit) for _ in patterns]
+    for n in range(length):
+        values: list[bool] = [pattern[n] == "1" for pattern in patterns]
+        bhba64.update(values)
+        for bhb64, value in zip(bhbs, values):
+            bhb64.update(value)
+
+    hits, updates, _ = bhba64.totals()
+    assert list(hits) == [bhb64.totals()[0] for bhb64 in bhbs]
+    assert updates == length
+    start: int = randint(0, len(bhba64))
+    window: int = randint(0, len(bhba64) - start)
+    hits, updates, _ = bhba64.history_totals(start, window)
+    for entry, bhb64 in enumerate(bhbs):
+        assert (hits[entry], updates) == bhb64.history_totals(start, window)[:2]
+        assert bhba64.history(entry, start, window).as_str() == bhb64.as_str(start, window)
+
+
+def test_bhba_values() -> None:
+    """Test bhba treats truthy values as True & returns copies of its counters."""
+    bhba64 = bhba(3)
+    bhba64.update([2, 0, 1])
+    bhba64.update([0, 0, 0])
+    hits, _ = bhba64.counts()
+    assert list(hits) == [1, 0, 1]
+    assert bhba64.history(0).as_str() == "10"
+    hits[:] = 7
+    bhba64.totals()[0][:] = 7
+    assert list(bhba64.hits) == [1, 0, 1]
+
+
+@pytest.mark.parametrize("pattern, bits", tuple(zip(TEST_HF_RND_PATTERNS[:8], TEST_HF_RND_BITS[:8])))
+def test_bhbz_rnd_patterns(pattern, bits) -> None:
+    """Test bhbz totals & histories against random patterns."""
+    bhbz64 = bhbz()
+    bhbz64.extend(bits)
+    hits, updates, ratio = bhbz64.totals()
+    assert hits == pattern.count("1")
+    assert updates == len(pattern)
+    assert isclose(ratio, pattern.count("1") / len(pattern))
+
+    # The first store holds the most recent 64 bits at full fidelity
+    total_hits, total_bits, _ = bhbz64.histories()
+    assert total_hits[0] - (total_bits[0] - 64) <= pattern[-64:].count("1") <= total_hits[0]
+    assert total_bits[-1] <= len(pattern)
+
+    # Inserting the values one at a time gives the same history
+    bhbz64_updated = bhbz()
+    for bit in pattern:
+        bhbz64_updated.update(bit == "1")
+    assert (bhbz64_updated.histories()[0] == total_hits).all()
+    assert (bhbz64_updated.histories()[1] == total_bits).all()
+
+
+def test_bhbzt_update_all() -> None:
+    """Test updating all the entries of a bhbz table matches updating each entry."""
+    patterns: list[LiteralString] = TEST_HF_RND_PATTERNS[:8]
+    length: int = min(len(pattern) for pattern in patterns)
+    vectorized = bhbzt(len(patterns), 3)
+    table = bhbzt(len(patterns), 3)
+    for n in range(length):
+        values: list[bool] = [pattern[n] == "1" for pattern in patterns]
+        if n & 1:
+            vectorized.update_all(values[::2], range(0, len(patterns), 2))
+            for entry in range(0, len(patterns), 2):
+                table[entry] = values[entry]
+        else:
+            vectorized.update_all(values)
+            for entry, value in enumerate(values):
+                table[entry] = value
+    vectorized.update_all([], [])  # No entries is a no-op
+    for entry in range(len(patterns)):
+        assert (vectorized[entry].histories()[0] == table[entry].histories()[0]).all()
+        assert (vectorized[entry].histories()[1] == table[entry].histories()[1]).all()
+
+
+def test_bhbzt_update_many(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test updating a bhbz table with many values in tiles matches updating it a row at a time."""
+    monkeypatch.setattr(import_module("binary_history_buffer.binary_history_buffer_z"), "_TILE_SIZE", 3)
+    values: NDArray[uint8] = array([bits[:4096] for bits in TEST_LF_RND_BITS[:8]]).T
+    vectorized = bhbzt(values.shape[1], 4)
+    table = bhbzt(values.shape[1], 4)
+    vectorized.update_many(values)
+    for row in values:
+        table.update_all(row)
+    for state in ("buffer", "hits", "updates", "_carry", "_hold", "_hold_valid"):
+        assert (getattr(vectorized, state) == getattr(table, state)).all()
+
+
+def test_bhbzt_length() -> None:
+    """Test a z table has at most 64 stores."""
+    assert bhbzt(1, 64).buffer.shape == (1, 64)
+    with pytest.raises(ValueError):
+        bhbzt(1, 65)
+
+
+def test_no_updates() -> None:
+    """Test the counts & totals of buffers with no updates."""
+    with catch_warnings():
+        simplefilter("error", RuntimeWarning)
+        for buffer in (bhb(), bhbz()):
+            assert buffer.counts() == (0, 0)
+            assert isnan(buffer.totals()[2])
+        assert isnan(bhb().history_totals(0)[2])
+        assert isnan(bhbz().histories()[2]).all()
+        assert isnan(bhba(4).totals()[2]).all()
+
+
+def test_bhbl2t_update_all() -> None:
+    """Test updating all the entries of a bhbl2 table matches updating each entry."""
+    patterns: list[NDArray[uint8]] = TEST_LF_RND_BITS[:8]
+    vectorized = bhbl2t(len(patterns), 2)
+    table = bhbl2t(len(patterns), 2)
+    for n in range(200):
+        values: list[int] = [int(bits[n]) * 2 for bits in patterns]  # Truthy values are True
+        if n & 1:
+            vectorized.update_all(values[::2], range(0, len(patterns), 2))
+            for entry in range(0, len(patterns), 2):
+                table[entry] = bool(values[entry])
+        else:
+            vectorized.update_all(values)
+            for entry, value in enumerate(values):
+                table[entry] = bool(value)
+    assert (vectorized.buffer == table.buffer).all()
+    assert (vectorized.hits == table.hits).all()
+    assert (vectorized.updates == table.updates).all()
+
+
+def test_bhbl2t_update_all_tiled(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test updating a bhbl2 table in tiles that end mid-table matches updating it in one tile."""
+    patterns: list[NDArray[uint8]] = TEST_LF_RND_BITS[:10]
+    tiled = bhbl2t(len(patterns), 2)
+    untiled = bhbl2t(len(patterns), 2)
+    for n in range(200):
+        values: list[int] = [int(bits[n]) for bits in patterns]
+        untiled.update_all(values)
+        with monkeypatch.context() as patch:
+            patch.setattr(import_module("binary_history_buffer.binary_history_buffer_log2"), "_TILE_SIZE", 4)
+            tiled.update_all(values)
+    assert (tiled.buffer == untiled.buffer).all()
+    assert (tiled.hits == untiled.hits).all()
+    assert (tiled.updates == untiled.updates).all()
+
+
+@pytest.mark.parametrize("nlsb", (0, 3))
+def test_bhbl2_extend(nlsb: int) -> None:
+    """Test extending a bhbl2 matches updating it one value at a time."""
+    table = bhbl2t(2, nlsb)
+    for bits in (TEST_LF_RND_BITS[0][:5], TEST_LF_RND_BITS[1][:64], TEST_LF_RND_BITS[2][:300], []):
+        table[0].extend(bits)
+        for bit in bits:
+            table[1].update(bool(bit))
+        assert table.buffer[0] == table.buffer[1]
+        assert table[0].counts() == table[1].counts()
+
+
+def test_mapped_bhbl2t() -> None:
+    """Test the key to entry mapping of a mapped bhbl2 table."""
+    table = mapped_binary_history_buffer_log2_table(2)
+    assert table.index_of("x") == 0
+    assert table.index_of("y") == 1
+    assert table.index_of("x") == 0
+    with pytest.raises(IndexError):
+        table.index_of("z")
+    with pytest.raises(KeyError):
+        table["z"]
+
+    table["x"] = True
+    table.update_by_index(table.index_of("y"), True)
+    table["x"].update(True)  # A keyed view writes to its entry, not to a key
+    table["y"].extend([False, False])
+    assert table["x"].counts() == (2, 2)
+    assert table["y"].counts() == (1, 3)
+    assert table._keys == {"x": 0, "y": 1}
+
+
 def test_plot():
-    ratio_histories = zeros((2, 8, len(TEST_HF_RND_PATTERNS[0])), dtype=float64)
+    """Plot the difference between the bhbz store ratios & the equivalent bhb history ratios."""
+    pattern: str = TEST_HF_RND_PATTERNS[0][:256]  # Only the first 256 updates are plotted
+    ratio_histories = zeros((2, 8, len(pattern)), dtype=float64)
     bhb64 = bhb()
-    bhbl264 = bhbz(length=8)
-    for n, bit in enumerate(TEST_HF_RND_PATTERNS[0]):
+    bhbl264 = bhbz(bhbzt(1, 8))
+    for n, bit in enumerate(pattern):
         bhb64.update(bit == "1")
         bhbl264.update(bit == "1")
         for i, (l2, bh) in enumerate(
             zip(
                 zip(*bhbl264.histories()),
-                (bhb64.history(2**n - 64) for n in range(7, 15)),
+                (bhb64.history_totals(0, 2**k - 64) for k in range(7, 15)),
             )
         ):
             ratio_histories[0, i, n] = l2[2]
             ratio_histories[1, i, n] = bh[2]
+    assert ((ratio_histories >= 0) & (ratio_histories <= 1)).all()
 
     for i, c in enumerate(
         ("red", "green", "blue", "black", "yellow", "cyan", "magenta", "orange")
     ):
         # plt.plot(ratio_histories[0, i], linestyle='dashed', color=c)
         plt.plot(
-            ratio_histories[0, i, :256] - ratio_histories[1, i, :256],
+            ratio_histories[0, i] - ratio_histories[1, i],
             linestyle="solid",
             color=c,
             linewidth=1,
         )
-
-    plt.show()
+    plt.close()